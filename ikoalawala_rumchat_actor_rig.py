@@ -12,12 +12,22 @@
 
 S.D.G."""
 
+import asyncio
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
 from pathlib import Path
+import re
+import string
+import sys
 import threading
 import time
-import queue
+import zlib
+import httpx
+import numpy as np
 import openai
+import orjson
 import rumchat_actor
 
 #Text encoding to use when opening and saving files
@@ -44,12 +54,53 @@ class Static:
         with open("openai_api_key.txt", encoding = TEXT_ENCODING) as f:
             api_key = f.read().strip()
 
-        #Delay between tries if a rate limit error is reached
+        #Delay between tries if a rate limit error is reached without a Retry-After header, doubled on each retry
         rate_limit_delay = 23
 
         #Max number of tries before giving up on avoiding a rate limit
         rate_limit_max_tries = 4
 
+        #Max number of queued messages to moderate in one request
+        moderation_batch_size = 16
+
+        #Tokens that send a message to OpenAI moderation, one per line. This file is not shipped and must be supplied to enable the
+        #local pre-filter, which also needs pyahocorasick. Without it, everything is sent to OpenAI moderation.
+        flagged_tokens_fn = os.path.join(Path(__file__).parent, "moderation_flagged_tokens.txt")
+        try:
+            with open(flagged_tokens_fn, encoding = TEXT_ENCODING) as f:
+                flagged_tokens = [token.lower() for token in f.read().splitlines() if token]
+        except FileNotFoundError:
+            flagged_tokens = []
+
+        #Message texts shorter than this (not counting the username) with no flagged tokens are considered clean without OpenAI moderation
+        prefilter_max_len = 40
+
+        #Max number of moderation results to remember, least recently used are forgotten first
+        moderation_cache_size = 4096
+
+        #Requests and tokens per minute allowed by our OpenAI tier. OpenAI limits each model separately.
+        chat_requests_per_minute = 500
+        chat_tokens_per_minute = 30000
+        embedding_requests_per_minute = 3000
+        embedding_tokens_per_minute = 1000000
+        moderation_requests_per_minute = 1000
+        moderation_tokens_per_minute = 150000
+
+        #Rough number of characters per token, for estimating request sizes
+        chars_per_token = 4
+
+        #Tokens to budget for an LLM response
+        response_tokens_estimate = 100
+
+        #Number of messages to process concurrently
+        message_worker_count = max(1, chat_requests_per_minute // 60)
+
+        #Max number of OpenAI requests in flight at once
+        max_concurrent_requests = 8
+
+        #HTTP connection pool limits for the OpenAI client, keeping connections warm between bursts of chat
+        http_limits = httpx.Limits(max_keepalive_connections = 32, max_connections = 64, keepalive_expiry = 120)
+
         #Response to give when rate limited
         rate_limited_response = "Sorry, @{message.user.username}, I'm exhausted. Try again next live stream."
 
@@ -73,13 +124,35 @@ class Static:
         remembered_users_fn = os.path.join(Path(__file__).parent, "remembered_users.txt")
 
         #User welcome prompt
-        user_welcome_prompt = "A user named {username} has entered the livestream chat. You do not remember ever seeing them before, though they may have been here sometime before you became staff. Write a short welcome, pinging them with @{username} somewhere in the message."
+        user_welcome_prompt = "A user named $username has entered the livestream chat. You do not remember ever seeing them before, though they may have been here sometime before you became staff. Write a short welcome, pinging them with @$username somewhere in the message."
+        user_welcome_template = string.Template(user_welcome_prompt)
 
         #Message too long response, currently unused
         #too_long_response = "That's too long. Please make it briefer."
 
         #User said something, respond prompt
-        user_respond_prompt = "The user {message.user.username} says the following to you:\n---\n{message.text}\n---\nWrite a short response, pinging them with @{username} somewhere in the message."
+        user_respond_prompt = "The user {message.user.username} says the following to you:\n---\n{message.text}\n---\nWrite a short response, pinging them with @{message.user.username} somewhere in the message."
+
+        #Embedding model used to look up similar prompts in the response cache
+        embedding_model = "text-embedding-3-small"
+
+        #Dimensions of the embedding model's vectors
+        embedding_dimensions = 1536
+
+        #Minimum cosine similarity for a cached response to be reused
+        response_cache_threshold = 0.92
+
+        #Max number of responses to cache, least recently used are evicted first
+        response_cache_max_entries = 2000
+
+        #Response cache file location
+        response_cache_fn = os.path.join(Path(__file__).parent, "response_cache.npz")
+
+        #Stand-in for the pinged user in cached responses
+        username_placeholder = "{username}"
+
+        #Kind of prompt that responses are cached for, kept apart from other kinds in the cache
+        user_respond_cache_kind = "user_respond"
 
     class Clip:
         """Data relating to the clip command"""
@@ -96,6 +169,144 @@ class Static:
         #OBS clipping hotkey
         obs_hotkey = ["\\"]
 
+class TokenBucket:
+    """Paces requests to stay under per-minute request and token limits"""
+    def __init__(self, rpm, tpm):
+        """Start with full buckets
+    rpm: Requests allowed per minute
+    tpm: Tokens allowed per minute"""
+
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        """Add the requests and tokens accrued since the last refill"""
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self.last_refill = now
+
+    async def acquire(self, n_tokens):
+        """Wait until one request and n_tokens are available, then take them"""
+        #A request bigger than the whole bucket can only ever wait for a full one
+        n_tokens = min(n_tokens, self.tpm)
+
+        #Only one waiter at a time, so requests are let through in order
+        async with self.lock:
+            self._refill()
+            while self.requests < 1 or self.tokens < n_tokens:
+                await asyncio.sleep(max((1 - self.requests) * 60 / self.rpm, (n_tokens - self.tokens) * 60 / self.tpm))
+                self._refill()
+
+            self.requests -= 1
+            self.tokens -= n_tokens
+
+class SemanticResponseCache:
+    """Cache of LLM responses, looked up by embedding similarity of their prompts"""
+    def __init__(self, fn, max_entries, dimensions):
+        """Set up the cache arrays, loading from disk if possible
+    fn: The .npz file to persist the cache to
+    max_entries: How many responses to keep before evicting
+    dimensions: The length of the embedding vectors"""
+
+        self.fn = fn
+        self.max_entries = max_entries
+
+        #Normalized embeddings of the prompts, one row per entry
+        self.vectors = np.zeros((max_entries, dimensions), dtype = np.float32)
+
+        #Checksums of the system prompt each entry was generated under
+        self.system_prompt_ids = np.zeros(max_entries, dtype = np.uint32)
+
+        #Use counter value of each entry's last hit, for LRU eviction
+        self.last_used = np.zeros(max_entries, dtype = np.int64)
+
+        #Reused buffers for similarity scores and the other system prompt mask during lookups
+        self._sims = np.empty(max_entries, dtype = np.float32)
+        self._mask = np.empty(max_entries, dtype = bool)
+
+        #The cached response texts, parallel to the arrays above
+        self.texts = []
+
+        #Incremented on every hit or addition
+        self.use_counter = 0
+
+        #Load the saved cache, if it exists
+        try:
+            with np.load(fn) as data:
+                count = min(len(data["texts"]), max_entries)
+                self.vectors[:count] = data["vectors"][:count]
+                self.system_prompt_ids[:count] = data["system_prompt_ids"][:count]
+                self.last_used[:count] = data["last_used"][:count]
+                self.texts = [str(text) for text in data["texts"][:count]]
+                self.use_counter = int(self.last_used[:count].max(initial = 0))
+
+        #Otherwise, start with an empty cache
+        except FileNotFoundError:
+            pass
+
+    def lookup(self, vector, system_prompt_id, threshold):
+        """Return the cached response for the most similar prompt, or None if nothing is similar enough
+    vector: The normalized embedding of the prompt
+    system_prompt_id: Checksum of the current system prompt
+    threshold: Minimum cosine similarity to count as a hit"""
+
+        count = len(self.texts)
+        if not count:
+            return None
+
+        #Cosine similarity of every entry in one BLAS pass, excluding those from other system prompts
+        sims = self._sims[:count]
+        np.dot(self.vectors[:count], vector, out = sims)
+        mask = self._mask[:count]
+        np.not_equal(self.system_prompt_ids[:count], system_prompt_id, out = mask)
+        np.copyto(sims, -1, where = mask)
+
+        best = int(np.argmax(sims))
+        if sims[best] < threshold:
+            return None
+
+        self.use_counter += 1
+        self.last_used[best] = self.use_counter
+        return self.texts[best]
+
+    def add(self, vector, system_prompt_id, text):
+        """Add a response to the cache, evicting the least recently used one if full
+    vector: The normalized embedding of the prompt
+    system_prompt_id: Checksum of the system prompt the response was generated under
+    text: The response"""
+
+        #There is room for a new entry
+        if len(self.texts) < self.max_entries:
+            index = len(self.texts)
+            self.texts.append(text)
+
+        #Replace the least recently used entry
+        else:
+            index = int(np.argmin(self.last_used))
+            self.texts[index] = text
+
+        self.use_counter += 1
+        self.vectors[index] = vector
+        self.system_prompt_ids[index] = system_prompt_id
+        self.last_used[index] = self.use_counter
+
+    def save(self):
+        """Save the cache to disk"""
+        count = len(self.texts)
+        np.savez(
+            self.fn,
+            vectors = self.vectors[:count],
+            system_prompt_ids = self.system_prompt_ids[:count],
+            last_used = self.last_used[:count],
+            texts = np.array(self.texts, dtype = str),
+            )
+
 class LLMChatBot:
     """LLM chat bot according to iKoalaWala's specifications"""
     def __init__(self, actor):
@@ -105,104 +316,251 @@ class LLMChatBot:
         #Save the actor
         self.actor = actor
 
+        #What a message starts with when it pings us
+        self._ping_prefix = f"@{self.actor.username}"
+
         #Create OpenAI client
-        self.client = openai.OpenAI(api_key = Static.LLM.api_key)
+        self.client = openai.AsyncOpenAI(api_key = Static.LLM.api_key, http_client = openai.DefaultAsyncHttpxClient(limits = Static.LLM.http_limits))
+
+        #Limit on OpenAI requests in flight
+        self.request_limiter = asyncio.Semaphore(Static.LLM.max_concurrent_requests)
+
+        #Local pre-filter for obviously clean messages, only if we have tokens to look for
+        if Static.LLM.flagged_tokens:
+            import ahocorasick #Only needed for the pre-filter
+            self.flagged_token_automaton = ahocorasick.Automaton()
+            for token in Static.LLM.flagged_tokens:
+                self.flagged_token_automaton.add_word(token, token)
+            self.flagged_token_automaton.make_automaton()
+        else:
+            self.flagged_token_automaton = None
+
+        #Recent moderation results by expression, in least to most recently used order
+        self.moderation_cache = OrderedDict()
+
+        #Pacing of OpenAI requests to stay under each model's rate limits
+        self.chat_rate_limiter = TokenBucket(Static.LLM.chat_requests_per_minute, Static.LLM.chat_tokens_per_minute)
+        self.embedding_rate_limiter = TokenBucket(Static.LLM.embedding_requests_per_minute, Static.LLM.embedding_tokens_per_minute)
+        self.moderation_rate_limiter = TokenBucket(Static.LLM.moderation_requests_per_minute, Static.LLM.moderation_tokens_per_minute)
+
+        #Cache of previous LLM responses
+        self.response_cache = SemanticResponseCache(Static.LLM.response_cache_fn, Static.LLM.response_cache_max_entries, Static.LLM.embedding_dimensions)
 
         #Load remembered user list, if it exists
-        if os.path.exists(Static.LLM.remembered_users_fn):
-            with open(Static.LLM.remembered_users_fn, encoding = TEXT_ENCODING) as f:
-                self.remembered_users = f.read().strip().splitlines()
+        try:
+            with open(Static.LLM.remembered_users_fn, "rb") as f:
+                self.remembered_users = {sys.intern(username) for username in f.read().decode(TEXT_ENCODING).splitlines() if username}
 
-        #Otherwise, create the remembered users list as blank
-        else:
-            self.remembered_users = []
+        #Otherwise, create the remembered users set as blank
+        except FileNotFoundError:
+            self.remembered_users = set()
+
+        #Keep the user memory file open for appending new users
+        self._users_fh = open(Static.LLM.remembered_users_fn, "a", buffering = 8192, encoding = TEXT_ENCODING)
+        atexit.register(self._users_fh.close)
+
+        #Current character index and the monotonic time it rotates next, starting in step with the wall clock seasons
+        season_position = time.time() % (Static.LLM.character_season_length * len(Static.LLM.character_prompts))
+        self._char_idx = int(season_position // Static.LLM.character_season_length)
+        self._char_next_ts = time.monotonic() + Static.LLM.character_season_length - season_position % Static.LLM.character_season_length
+
+        #The full system prompt for each character, with its checksum and chat message. Kept byte-identical for provider-side prefix caching
+        self._sys_prompts = [Static.LLM.livestream_behavior_prompt.format(actor = self.actor) + " " + character_prompt for character_prompt in Static.LLM.character_prompts]
+        self._sys_prompt_ids = [zlib.crc32(system_prompt.encode(TEXT_ENCODING)) for system_prompt in self._sys_prompts]
+        self._sys_msgs = [{"role": "system", "content": system_prompt} for system_prompt in self._sys_prompts]
 
         #Wether or not we have been rate limited for the day / entire livestream
         self.permanent_rate_limit = False
 
-        self.messages_to_process = queue.Queue()
+        #Event loop the message processor runs in, fed from the actor's thread
+        self.event_loop = asyncio.new_event_loop()
+        self.messages_to_process = asyncio.Queue()
+
+        #Single thread for the actor's blocking sends, so they go out one at a time without stalling the event loop
+        self._send_executor = ThreadPoolExecutor(max_workers = 1)
 
-        self.message_processor_thread = threading.Thread(target = self.message_processing_loop)
+        self.message_processor_thread = threading.Thread(target = self.event_loop.run_until_complete, args = (self.message_processing_loop(),))
         self.message_processor_thread.start()
 
     def action(self, message, _):
         """Message action to be registered"""
-        self.messages_to_process.put(message)
+        self.event_loop.call_soon_threadsafe(self.messages_to_process.put_nowait, message)
+
+    async def message_processing_loop(self):
+        """Process messages with several concurrent workers"""
+        try:
+            await asyncio.gather(*(self.message_worker() for _ in range(Static.LLM.message_worker_count)))
+
+        #Keep the cache even if we went down badly
+        finally:
+            self.response_cache.save()
+            self._send_executor.shutdown()
+            print("LLM chat bot message processor shut down.")
 
-    def message_processing_loop(self):
-        """Process messages one at a time"""
+    async def message_worker(self):
+        """Process messages in batches, moderating each batch with one request"""
         #While the actor is alive
         while self.actor.keep_running:
 
-            #Wait for a new message to process, checking the loop condition frequently
+            #Wait for a new message to process, checking the loop condition periodically
             try:
-                message = self.messages_to_process.get_nowait()
-            except queue.Empty:
-                time.sleep(0.1)
+                batch = [await asyncio.wait_for(self.messages_to_process.get(), timeout = 0.5)]
+            except asyncio.TimeoutError:
                 continue
 
-            #This is a new user, greet them
-            if not self.remember_user(message.user.username) \
-                and self.is_clean(message.user.username + " said, " + message.text):
+            #Take whatever else has queued up, to moderate along with it
+            while len(batch) < Static.LLM.moderation_batch_size:
+                try:
+                    batch.append(self.messages_to_process.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
 
-                self.greet_user(message.user.username)
-                continue
-
-            #The user pinged us, generate a response to their message
-            if message.text.startswith(f"@{self.actor.username}"):
-                #Get message cleanliness (WARNING: defaults to False if rate limited)
-                clean = self.is_clean(message.user.username + " said, " + message.text)
-
-                #The message and username were clean
-                if clean:
-                    reply = self.get_llm_message(Static.LLM.user_respond_prompt.format(message = message))
-                    #We have a reply, send it and finish with this message
-                    if reply:
-                        self.actor.send_message(reply)
-                        continue
-
-                #We cannot respond because we are rate limited (before or after trying to generate a reply)
-                if self.permanent_rate_limit:
-                    self.actor.send_message(Static.LLM.rate_limited_response.format(message = message))
-                    continue
+            #A failed moderation request only drops this batch, not the worker
+            try:
+                await self.process_batch(batch)
+            except Exception as e:
+                print("Error moderating messages:", e)
+
+    async def process_batch(self, batch):
+        """Moderate a batch of messages in one request, then respond to each concurrently"""
+        #Only new users and pings need moderation
+        new_users = [not self.remember_user(message.user.username) for message in batch]
+        to_check = [i for i, message in enumerate(batch) if new_users[i] or message.text.startswith(self._ping_prefix)]
+
+        #Get cleanliness of each (WARNING: defaults to False if rate limited)
+        cleanliness = dict(zip(to_check, await self.is_clean_batch(
+            [batch[i].user.username + " said, " + batch[i].text for i in to_check],
+            [batch[i].text for i in to_check],
+            )))
+
+        #A failure responding to one message does not affect the others
+        results = await asyncio.gather(*(self.process_message(message, new_users[i], cleanliness.get(i, False)) for i, message in enumerate(batch)), return_exceptions = True)
+        for message, result in zip(batch, results):
+            if isinstance(result, Exception):
+                print("Error processing message from", message.user.username + ":", result)
+
+    async def process_message(self, message, new_user, clean):
+        """Respond to a single message
+    message: The chat message
+    new_user: Wether or not this is the first time we've seen the user
+    clean: Wether or not the message and username passed moderation"""
+
+        #This is a new user, greet them
+        if new_user and clean:
+            await self.greet_user(message.user.username)
+            return
 
-        print("LLM chat bot message processor shut down.")
+        #The user pinged us, generate a response to their message
+        if message.text.startswith(self._ping_prefix):
+            #The message and username were clean
+            if clean:
+                reply = await self.get_llm_message(Static.LLM.user_respond_prompt.format(message = message), message.text.removeprefix(self._ping_prefix).lstrip(), Static.LLM.user_respond_cache_kind, message.user.username)
+                #We have a reply, send it and finish with this message
+                if reply:
+                    await self.send_message(reply)
+                    return
+
+            #We cannot respond because we are rate limited (before or after trying to generate a reply)
+            if self.permanent_rate_limit:
+                await self.send_message(Static.LLM.rate_limited_response.format(message = message))
+
+    async def send_message(self, text):
+        """Send a chat message through the actor, off of the event loop"""
+        await self.event_loop.run_in_executor(self._send_executor, self.actor.send_message, text)
+
+    async def _run_rate_limited(self, call, rate_limiter, estimated_tokens):
+        """Await a coroutine function with OpenAI rate limit pacing, catch, and concurrency limit
+    call: The coroutine function making the request
+    rate_limiter: The TokenBucket for the model being used
+    estimated_tokens: Roughly how many tokens the request will use"""
 
-    def _run_rate_limited(self, call):
-        """Run a callable with OpenAI rate limiting catch"""
         #We have already been permanently rate limited
         if self.permanent_rate_limit:
             return
 
-        #We were not yet rate limited in this try
-        rate_limited = False
-
         #Try a few times
-        for _ in range(Static.LLM.rate_limit_max_tries):
-            #If we were rate limited, wait
-            if rate_limited:
-                time.sleep(Static.LLM.rate_limit_delay)
+        for attempt in range(Static.LLM.rate_limit_max_tries):
+            #Wait for our turn under the rate limits
+            await rate_limiter.acquire(estimated_tokens)
 
             #Try to get a result
             try:
-                return call()
+                async with self.request_limiter:
+                    return await call()
 
-            #We were rate limited
-            except openai.RateLimitError:
-                rate_limited = True
+            #We were rate limited anyways, wait before trying again
+            except openai.RateLimitError as e:
+                if attempt + 1 < Static.LLM.rate_limit_max_tries:
+                    await asyncio.sleep(self._rate_limit_retry_delay(e, attempt))
 
         #We ran out of tries
         self.permanent_rate_limit = True
 
-    def is_clean(self, expression):
-        """Use OpenAI moderation to check if something is clean or not (rate limit check)"""
-        return self._run_rate_limited(lambda: self._is_clean(expression))
+    @staticmethod
+    def _estimate_tokens(text):
+        """Roughly how many tokens some text is"""
+        return len(text) // Static.LLM.chars_per_token
 
-    def _is_clean(self, expression):
-        """Use OpenAI moderation to check if something is clean or not"""
-        moderation_response = self.client.moderations.create(input = expression)
-        flagged = moderation_response.results[0].flagged
-        return not flagged
+    @staticmethod
+    def _rate_limit_retry_delay(error, attempt):
+        """How long to wait after a rate limit error, from its Retry-After header or exponential backoff"""
+        try:
+            return float(error.response.headers["retry-after"])
+        except (KeyError, ValueError):
+            return Static.LLM.rate_limit_delay * 2 ** attempt
+
+    def is_obviously_clean(self, expression, text):
+        """Check if something is short and contains no flagged tokens, so needs no OpenAI moderation
+    expression: The full thing to check for flagged tokens
+    text: The part of it that must be short, i.e. the message text without the username"""
+
+        if not self.flagged_token_automaton or len(text) >= Static.LLM.prefilter_max_len:
+            return False
+        return next(self.flagged_token_automaton.iter(expression.lower()), None) is None
+
+    async def is_clean_batch(self, expressions, texts):
+        """Use OpenAI moderation to check if each of several things is clean or not (rate limit check, False if rate limited)
+    expressions: The things to check
+    texts: The part of each expression the pre-filter length limit applies to"""
+
+        cleanliness = [True if self.is_obviously_clean(expression, text) else self._get_cached_moderation(expression) for expression, text in zip(expressions, texts)]
+
+        #Send everything the pre-filter and cache could not clear to OpenAI
+        to_check = [i for i, clean in enumerate(cleanliness) if clean is None]
+        if to_check:
+            to_check_expressions = [expressions[i] for i in to_check]
+            results = await self._run_rate_limited(lambda: self._is_clean_batch(to_check_expressions), self.moderation_rate_limiter, sum(map(self._estimate_tokens, to_check_expressions)))
+
+            #We were rate limited, don't remember the default
+            if results is None:
+                results = [False] * len(to_check)
+            else:
+                for expression, clean in zip(to_check_expressions, results):
+                    self._cache_moderation(expression, clean)
+
+            for i, clean in zip(to_check, results):
+                cleanliness[i] = clean
+
+        return cleanliness
+
+    def _get_cached_moderation(self, expression):
+        """Get a remembered moderation result, or None if we don't have one"""
+        clean = self.moderation_cache.get(expression)
+        if clean is not None:
+            self.moderation_cache.move_to_end(expression)
+        return clean
+
+    def _cache_moderation(self, expression, clean):
+        """Remember a moderation result, forgetting the least recently used if full"""
+        self.moderation_cache[expression] = clean
+        self.moderation_cache.move_to_end(expression)
+        if len(self.moderation_cache) > Static.LLM.moderation_cache_size:
+            self.moderation_cache.popitem(last = False)
+
+    async def _is_clean_batch(self, expressions):
+        """Use OpenAI moderation to check if each of several things is clean or not, in one request"""
+        moderation_response = await self.client.moderations.with_raw_response.create(input = expressions)
+        return [not result["flagged"] for result in orjson.loads(moderation_response.content)["results"]]
 
     # def auto_moderate(self, message):
     #     """Automatically moderate a message, returns True if deleted"""
@@ -215,50 +573,115 @@ class LLMChatBot:
 
         #User was not remembered, make note
         print("New user", username)
-        self.remembered_users.append(username)
-        with open(Static.LLM.remembered_users_fn, "a", encoding = TEXT_ENCODING) as f:
-            f.write("\n" + username)
+        self.remembered_users.add(sys.intern(username))
+        self._users_fh.write("\n" + username)
+        self._users_fh.flush()
         return False
 
-    def greet_user(self, username):
+    async def greet_user(self, username):
         """Greet a first-time chatting user"""
         print("Greeting", username)
-        Static.LLM.user_welcome_prompt.format(username = username)
-        message = self.get_llm_message(Static.LLM.user_welcome_prompt.format(username = username))
+        message = await self.get_llm_message(Static.LLM.user_welcome_template.substitute(username = username))
         if not message: #Getting a message failed
             print("Message generation failed.")
             return
-        self.actor.send_message(message)
+        await self.send_message(message)
 
     @property
     def current_character(self):
         """The current index of character prompts to use"""
-        return (time.time() % (Static.LLM.character_season_length * len(Static.LLM.character_prompts))) // Static.LLM.character_season_length
+        now = time.monotonic()
+
+        #Rotate through any seasons that have ended since we last checked
+        while now >= self._char_next_ts:
+            self._char_idx = (self._char_idx + 1) % len(Static.LLM.character_prompts)
+            self._char_next_ts += Static.LLM.character_season_length
+
+        return self._char_idx
 
     @property
     def current_system_prompt(self):
         """The current system LLM prompt, as defined by the current character"""
-        return Static.LLM.livestream_behavior_prompt.format(actor = self.actor) + " " + Static.LLM.character_prompts[self.current_character]
+        return self._sys_prompts[self.current_character]
+
+    @property
+    def current_system_message(self):
+        """The current system LLM prompt, as a chat message"""
+        return self._sys_msgs[self.current_character]
+
+    @property
+    def current_system_prompt_id(self):
+        """Checksum of the current system LLM prompt"""
+        return self._sys_prompt_ids[self.current_character]
+
+    async def get_llm_message(self, prompt, cache_text = None, cache_kind = None, username = None):
+        """Get an LLM response to a prompt, reusing a cached response to similar text if possible
+    prompt: The prompt to respond to
+    cache_text: The variable part of the prompt to look up similar responses by, None to not use the cache
+    cache_kind: What kind of prompt this is, responses are only reused for the same kind. Required to use the cache
+    username: The user the response should ping, swapped out so responses can be reused for other users. Required to use the cache"""
+
+        #Not cacheable, just get a response
+        if not cache_text or not cache_kind or not username:
+            return await self._request_llm_message(prompt)
+
+        #Entries are only shared between the same system prompt and kind of prompt
+        cache_id = zlib.crc32(cache_kind.encode(TEXT_ENCODING), self.current_system_prompt_id)
+
+        #Look for a cached response to similar text
+        vector = await self._get_cache_vector(cache_text)
+        if vector is not None:
+            text = self.response_cache.lookup(vector, cache_id, Static.LLM.response_cache_threshold)
+            if text:
+                print("Using cached LLM response")
+                return text.replace("@" + Static.LLM.username_placeholder, "@" + username)
+
+        text = await self._request_llm_message(prompt)
+        if not text or vector is None:
+            return text
+
+        #Cache the new response, only if the user is named in it exactly once, as a whole @ping
+        generic_text, pings = re.subn(r"(?<!\w)@" + re.escape(username) + r"(?!\w)", "@" + Static.LLM.username_placeholder, text)
+        if pings == 1 and not re.search(r"(?<!\w)" + re.escape(username) + r"(?!\w)", generic_text, re.IGNORECASE):
+            self.response_cache.add(vector, cache_id, generic_text)
+
+        return text
+
+    async def _request_llm_message(self, prompt):
+        """Get a new LLM response to a prompt (rate limit check)"""
+        return await self._run_rate_limited(lambda: self._get_llm_message(prompt), self.chat_rate_limiter, self._estimate_tokens(self.current_system_prompt + prompt) + Static.LLM.response_tokens_estimate)
+
+    async def _get_cache_vector(self, text):
+        """Get the embedding to look up a response by, or None on any failure. The cache is optional, so this neither retries nor counts towards the permanent rate limit"""
+        await self.embedding_rate_limiter.acquire(self._estimate_tokens(text))
+        try:
+            async with self.request_limiter:
+                return await self._get_embedding(text)
+        except Exception as e:
+            print("Embedding error, skipping response cache:", e)
+            return None
 
-    def get_llm_message(self, prompt):
-        """Get an LLM response to a prompt (rate limit check)"""
-        return self._run_rate_limited(lambda: self._get_llm_message(prompt))
+    async def _get_embedding(self, text):
+        """Get the normalized embedding vector of some text"""
+        response = await self.client.embeddings.create(model = Static.LLM.embedding_model, input = text)
+        vector = np.asarray(response.data[0].embedding, dtype = np.float32)
+        return vector / np.linalg.norm(vector)
 
-    def _get_llm_message(self, prompt):
+    async def _get_llm_message(self, prompt):
         """Get an LLM response to a prompt"""
         print("Getting LLM response to prompt")
-        response = self.client.chat.completions.create(
+        response = await self.client.chat.completions.with_raw_response.create(
         model = Static.LLM.gpt_model,
         messages=[
-            {"role": "system", "content": self.current_system_prompt},
+            self.current_system_message,
             {"role": "user", "content": prompt},
         ]
         )
         try:
-            text = response.choices[0].message.content
+            text = orjson.loads(response.content)["choices"][0]["message"]["content"]
         except Exception as e:
             print("LLM error:", e)
-            print(response)
+            print(response.content)
             if isinstance(e, openai.RateLimitError):
                 raise
             return